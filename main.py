@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, g
 from flask_cors import CORS
 import os
 import datetime
@@ -8,13 +8,27 @@ import requests
 import uuid
 import mimetypes
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne, DeleteOne
 from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
 from bson import ObjectId, Binary
 from functools import wraps
 import pytz
+import numpy as np
 import io
 import gridfs
+import wave
+import math
+import hmac
+import hashlib
+import heapq
+import re
+import json
+import zlib
+import fcntl
+import mmap
+import struct
+import calendar
+from contextlib import contextmanager
 from PIL import Image
 
 load_dotenv()
@@ -65,6 +79,642 @@ def require_auth(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Number of points stored for each voice note waveform
+WAVEFORM_PEAKS = 100
+
+def parse_duration(value):
+    """Convert a client-sent duration to seconds, defaulting to 0"""
+    try:
+        duration = float(value)
+    except (TypeError, ValueError):
+        return 0
+    return duration if math.isfinite(duration) and duration >= 0 else 0
+
+def probe_audio(file_data, num_peaks=WAVEFORM_PEAKS):
+    """Probe the duration and compute downsampled waveform peaks of an audio file
+
+    Only uncompressed PCM WAV is decoded. Returns (duration, peaks) with peaks
+    normalized to 0-1, or (None, None) if the audio could not be decoded.
+    """
+    try:
+        with wave.open(io.BytesIO(file_data), 'rb') as wav:
+            channels = wav.getnchannels()
+            sample_width = wav.getsampwidth()
+            frame_rate = wav.getframerate()
+            frames = wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError):
+        return None, None
+
+    if not frame_rate or sample_width not in (1, 2, 4):
+        return None, None
+
+    # WAV samples are little-endian; 8-bit samples are unsigned around 128
+    dtype = np.dtype({1: '<u1', 2: '<i2', 4: '<i4'}[sample_width])
+    frame_bytes = sample_width * channels
+    samples = np.frombuffer(frames, dtype=dtype, count=len(frames) // frame_bytes * channels)
+    samples = samples.reshape(-1, channels)
+    offset = 128 if sample_width == 1 else 0
+    max_amplitude = float(1 << (8 * sample_width - 1))
+
+    frame_count = len(samples)
+    duration = round(frame_count / frame_rate, 2)
+    if frame_count == 0:
+        return duration, []
+
+    # Take the loudest sample in each bucket across all channels; reducing the
+    # max and min separately avoids widening every sample to take abs()
+    num_peaks = min(num_peaks, frame_count)
+    starts = np.arange(num_peaks) * frame_count // num_peaks
+    highs = np.maximum.reduceat(samples, starts, axis=0).max(axis=1).astype(np.int64) - offset
+    lows = offset - np.minimum.reduceat(samples, starts, axis=0).min(axis=1).astype(np.int64)
+    peaks = np.minimum(np.maximum(highs, lows) / max_amplitude, 1.0)
+    peaks = [round(float(peak), 3) for peak in peaks]
+
+    return duration, peaks
+
+# Signed file URLs are valid for at least this many seconds
+SIGNED_URL_TTL = int(os.getenv('SIGNED_URL_TTL', 24 * 60 * 60))
+
+def _file_signature(file_id, expires):
+    """Compute the HMAC signature for a file URL"""
+    secret = os.getenv('FILE_URL_SECRET') or os.getenv('AUTH_CODE') or ''
+    message = f"{file_id}:{expires}".encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+def sign_file_url(file_id):
+    """Build a short-lived signed URL for a file
+
+    The expiry is rounded up to a TTL boundary so repeated requests within the
+    same window get an identical, browser-cacheable URL.
+    """
+    file_id = str(file_id)
+    now = int(time.time())
+    expires = (now // SIGNED_URL_TTL + 2) * SIGNED_URL_TTL
+    signature = _file_signature(file_id, expires)
+    return f"/files/{file_id}?expires={expires}&signature={signature}"
+
+def verify_file_signature(file_id, expires, signature):
+    """Check a file URL signature and that it has not expired"""
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return False
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(_file_signature(file_id, expires), signature or '')
+
+def require_auth_or_signature(f):
+    """Authentication decorator accepting either the auth header or a signed file URL"""
+    @wraps(f)
+    def decorated_function(file_id, *args, **kwargs):
+        # Record which check passed so responses can choose their cache scope
+        if request.headers.get('X-Auth-Code') == os.getenv('AUTH_CODE'):
+            g.file_auth = 'header'
+        elif verify_file_signature(file_id, request.args.get('expires'), request.args.get('signature')):
+            g.file_auth = 'signature'
+            g.file_expires = int(request.args['expires'])
+        else:
+            return jsonify({'error': 'Unauthorized'}), 401
+        return f(file_id, *args, **kwargs)
+    return decorated_function
+
+def add_settings_background_url(settings):
+    """Attach a signed URL for an uploaded settings background"""
+    if settings.get('background_type') == 'image' and ObjectId.is_valid(settings.get('background_value', '')):
+        settings['background_url'] = sign_file_url(settings['background_value'])
+    return settings
+
+def add_background_url(entry):
+    """Attach a signed URL for an entry's image background"""
+    background = entry.get('background')
+    if background and ObjectId.is_valid(background):
+        entry['background_url'] = sign_file_url(background)
+    return entry
+
+# Fields offered for autocomplete, counted in the shared autocomplete_counts collection
+AUTOCOMPLETE_FIELDS = ('tags', 'location', 'mood')
+AUTOCOMPLETE_MAX_RESULTS = 50
+AUTOCOMPLETE_REFRESH_SECONDS = 2
+
+class PrefixIndex:
+    """Case-insensitive snapshot of values and usage counts with precomputed completions
+
+    Every prefix of every value maps to its most used matches, so a lookup is a
+    single dict access regardless of how many values share the prefix.
+    """
+
+    def __init__(self, counts, max_results=AUTOCOMPLETE_MAX_RESULTS):
+        buckets = {}
+        for value, count in counts.items():
+            key = value.lower()
+            for end in range(len(key) + 1):
+                buckets.setdefault(key[:end], []).append((-count, key, value))
+        self.completions = {
+            prefix: [{'value': value, 'count': -count} for count, _, value in heapq.nsmallest(max_results, matches)]
+            for prefix, matches in buckets.items()
+        }
+
+    def complete(self, prefix, limit):
+        """Return the most used values starting with prefix"""
+        return self.completions.get(prefix.lower(), [])[:limit]
+
+autocomplete_indexes = None
+autocomplete_version = None
+autocomplete_checked_at = 0
+autocomplete_lock = threading.Lock()
+
+def _entry_field_values(entry, field):
+    """Get the non-empty string values of an entry field as a list"""
+    value = (entry or {}).get(field)
+    values = value if isinstance(value, list) else [value]
+    return [v for v in values if isinstance(v, str) and v.strip()]
+
+def _autocomplete_deltas(entry, delta, deltas):
+    """Accumulate count changes for an entry's values into deltas"""
+    for field in AUTOCOMPLETE_FIELDS:
+        for value in _entry_field_values(entry, field):
+            deltas[(field, value)] = deltas.get((field, value), 0) + delta
+
+def _apply_autocomplete_deltas(deltas):
+    """Apply count changes to the shared counts and bump the version"""
+    operations = [
+        UpdateOne({'field': field, 'value': value}, {'$inc': {'count': delta}}, upsert=True)
+        for (field, value), delta in deltas.items() if delta
+    ]
+    if not operations:
+        return
+    db.autocomplete_counts.bulk_write(operations, ordered=False)
+    db.autocomplete_counts.delete_many({'count': {'$lte': 0}})
+    db.app_meta.update_one({'_id': 'autocomplete'}, {'$inc': {'version': 1}}, upsert=True)
+
+def reconcile_autocomplete_counts():
+    """Recompute the shared counts from all entries and correct any drift
+
+    Runs at startup, so a first seed that was interrupted or a count update that
+    failed is repaired. Corrections use $set rather than $inc, so workers
+    reconciling at the same time converge on the same values.
+    """
+    db.autocomplete_counts.create_index([('field', 1), ('value', 1)], unique=True)
+    expected = {}
+    for entry in db.entries.find({}, {field: 1 for field in AUTOCOMPLETE_FIELDS}):
+        _autocomplete_deltas(entry, 1, expected)
+    actual = {(doc['field'], doc['value']): doc['count'] for doc in db.autocomplete_counts.find({})}
+    
+    operations = [
+        UpdateOne({'field': field, 'value': value}, {'$set': {'count': count}}, upsert=True)
+        for (field, value), count in expected.items() if actual.get((field, value)) != count
+    ]
+    operations += [
+        DeleteOne({'field': field, 'value': value})
+        for field, value in actual if (field, value) not in expected
+    ]
+    if operations:
+        db.autocomplete_counts.bulk_write(operations, ordered=False)
+        db.app_meta.update_one({'_id': 'autocomplete'}, {'$inc': {'version': 1}}, upsert=True)
+
+def get_autocomplete_indexes():
+    """Get the autocomplete indexes, reloading them when another worker changed the counts
+
+    The shared version is checked at most every AUTOCOMPLETE_REFRESH_SECONDS, so
+    most lookups never touch MongoDB.
+    """
+    global autocomplete_indexes, autocomplete_version, autocomplete_checked_at
+    with autocomplete_lock:
+        now = time.monotonic()
+        if autocomplete_indexes is not None and now - autocomplete_checked_at < AUTOCOMPLETE_REFRESH_SECONDS:
+            return autocomplete_indexes
+        autocomplete_checked_at = now
+        
+        meta = db.app_meta.find_one({'_id': 'autocomplete'}) or {}
+        version = meta.get('version', 0)
+        if autocomplete_indexes is None or version != autocomplete_version:
+            counts = {field: {} for field in AUTOCOMPLETE_FIELDS}
+            for doc in db.autocomplete_counts.find({'count': {'$gt': 0}}):
+                if doc['field'] in counts:
+                    counts[doc['field']][doc['value']] = doc['count']
+            autocomplete_indexes = {field: PrefixIndex(counts[field]) for field in AUTOCOMPLETE_FIELDS}
+            autocomplete_version = version
+        return autocomplete_indexes
+
+def sync_autocomplete(old_entry=None, new_entry=None):
+    """Reflect an entry write in the shared autocomplete counts
+
+    Failures are logged rather than raised, since the entry write has already
+    been committed; reconcile_autocomplete_counts repairs the drift at startup.
+    """
+    global autocomplete_checked_at
+    try:
+        deltas = {}
+        _autocomplete_deltas(old_entry, -1, deltas)
+        _autocomplete_deltas(new_entry, 1, deltas)
+        _apply_autocomplete_deltas(deltas)
+        
+        # Make this worker pick up its own write on the next lookup
+        with autocomplete_lock:
+            autocomplete_checked_at = 0
+    except Exception as e:
+        print(f"Error updating autocomplete counts: {e}")
+
+# Number of hashed term columns in the related-entries TF-IDF index
+RELATED_FEATURES = 1 << 18
+RELATED_INDEX_DIR = os.getenv('RELATED_INDEX_DIR', 'related_index')
+# Merge the change log into the base segment once it holds this many records
+# (or a quarter of the indexed entries, whichever is larger)
+RELATED_COMPACT_RECORDS = 256
+RELATED_STOPWORDS = {
+    'the', 'and', 'a', 'an', 'to', 'of', 'in', 'on', 'at', 'for', 'with', 'was',
+    'is', 'it', 'i', 'me', 'my', 'we', 'our', 'you', 'he', 'she', 'they', 'that',
+    'this', 'but', 'so', 'be', 'had', 'have', 'has', 'were', 'are', 'as', 'from'
+}
+RELATED_MAGIC = b'DIARYRI1'
+RELATED_HEADER = struct.Struct('<8sqQ')  # magic, generation, header/record length
+RELATED_RECORD = struct.Struct('<24sqIB3x')  # entry id, stamp, term count, op
+RELATED_UPSERT, RELATED_DELETE = 1, 2
+
+def entry_stamp(entry):
+    """Millisecond UTC timestamp of an entry's last write, used to spot stale index rows"""
+    stamp = (entry or {}).get('updated_at') or (entry or {}).get('created_at')
+    if not isinstance(stamp, datetime.datetime):
+        return 0
+    if stamp.tzinfo is None:
+        stamp = stamp.replace(tzinfo=datetime.timezone.utc)
+    # Integer arithmetic matches MongoDB's millisecond truncation exactly
+    return calendar.timegm(stamp.utctimetuple()) * 1000 + stamp.microsecond // 1000
+
+class RelatedIndex:
+    """Sparse TF-IDF index over entry content and tags for finding related entries
+
+    Entries live in a base segment file holding ids, stamps, IDF and the CSR
+    term data with L2-normalized weights. Workers memory-map it read-only, so
+    scoring runs straight from shared pages. Writes append small sparse records
+    to a change log, which is merged into a new base segment (recomputing IDF)
+    once it grows. The base file is replaced atomically and carries a
+    generation that the log must match. Readers hold a shared file lock and
+    writers an exclusive one.
+    """
+
+    def __init__(self, directory, features=RELATED_FEATURES):
+        self.features = features
+        self.base_path = os.path.join(directory, 'related.idx')
+        self.log_path = os.path.join(directory, 'related.log')
+        self.lock_path = os.path.join(directory, 'related.lock')
+        self.lock = threading.Lock()
+        self.base = None
+        self.base_inode = None
+        self.base_rows = {}
+        self.log_offset = 0
+        self.log_records = 0
+        self.overlay = {}  # entry id -> (stamp, indices, tf), or None when deleted
+        self.overlay_arrays = None
+        os.makedirs(directory, exist_ok=True)
+
+    def vectorize(self, entry):
+        """Hash an entry's content words and tags into sorted term columns and log counts"""
+        words = re.findall(r"\w+", str(entry.get('content') or '').lower())
+        terms = [word for word in words if len(word) > 1 and word not in RELATED_STOPWORDS]
+        # Tags are strong signals, so each one counts as two occurrences
+        for tag in entry.get('tags') or []:
+            terms += [f"tag:{str(tag).lower()}"] * 2
+        columns = np.array([zlib.crc32(term.encode()) % self.features for term in terms], dtype=np.int64)
+        indices, counts = np.unique(columns, return_counts=True)
+        return indices.astype(np.int32), np.log1p(counts).astype(np.float32)
+
+    @contextmanager
+    def _file_lock(self, operation):
+        """Hold the cross-worker lock in shared (LOCK_SH) or exclusive (LOCK_EX) mode"""
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _normalized_weights(self, row, indices, tf, rows, idf):
+        """Scale term frequencies by IDF and L2-normalize each row"""
+        weights = tf * idf[indices]
+        norms = np.sqrt(np.bincount(row, weights=weights * weights, minlength=rows))
+        norms[norms == 0] = 1
+        return (weights / norms[row]).astype(np.float32)
+
+    def _write_base(self, rows, generation):
+        """Atomically write a base segment from (entry id, stamp, indices, tf) rows"""
+        lengths = np.array([len(indices) for _, _, indices, _ in rows], dtype=np.int64)
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        row = np.repeat(np.arange(len(rows), dtype=np.int32), lengths)
+        indices = np.concatenate([r[2] for r in rows] + [np.zeros(0, dtype=np.int32)]).astype(np.int32)
+        tf = np.concatenate([r[3] for r in rows] + [np.zeros(0, dtype=np.float32)]).astype(np.float32)
+        document_frequency = np.bincount(indices, minlength=self.features)
+        idf = (np.log((1 + len(rows)) / (1 + document_frequency)) + 1).astype(np.float32)
+        weights = self._normalized_weights(row, indices, tf, len(rows), idf)
+
+        arrays = {'idf': idf, 'indptr': indptr, 'row': row, 'indices': indices, 'tf': tf, 'weights': weights}
+        layout, offset = {}, 0
+        for name, values in arrays.items():
+            layout[name] = [offset, values.dtype.str, len(values)]
+            offset += -(-values.nbytes // 8) * 8
+        header = json.dumps({
+            'features': self.features,
+            'ids': [r[0] for r in rows],
+            'stamps': [r[1] for r in rows],
+            'arrays': layout
+        }).encode()
+        data_start = -(-(RELATED_HEADER.size + len(header)) // 8) * 8
+
+        tmp_path = f"{self.base_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(RELATED_HEADER.pack(RELATED_MAGIC, generation, len(header)))
+            f.write(header)
+            for name, values in arrays.items():
+                f.seek(data_start + layout[name][0])
+                f.write(values.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.base_path)
+
+    def _reset_log(self, generation):
+        """Atomically replace the change log with an empty one for a base generation"""
+        tmp_path = f"{self.log_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(RELATED_HEADER.pack(RELATED_MAGIC, generation, 0))
+        os.replace(tmp_path, self.log_path)
+
+    def _load_base(self):
+        """Memory-map the base segment; ids and arrays come from one open file"""
+        with open(self.base_path, 'rb') as f:
+            inode = os.fstat(f.fileno()).st_ino
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, generation, header_length = RELATED_HEADER.unpack_from(buffer, 0)
+        if magic != RELATED_MAGIC:
+            raise ValueError('Invalid related index file')
+        header = json.loads(buffer[RELATED_HEADER.size:RELATED_HEADER.size + header_length])
+        if header['features'] != self.features:
+            raise ValueError('Related index feature count mismatch')
+        data_start = -(-(RELATED_HEADER.size + header_length) // 8) * 8
+        base = {
+            name: np.frombuffer(buffer, dtype=np.dtype(dtype), count=length, offset=data_start + offset)
+            for name, (offset, dtype, length) in header['arrays'].items()
+        }
+        base['generation'] = generation
+        base['ids'] = header['ids']
+        base['stamps'] = header['stamps']
+
+        self.base = base
+        self.base_inode = inode
+        self.base_rows = {entry_id: row for row, entry_id in enumerate(header['ids'])}
+        self.log_offset = 0
+        self.log_records = 0
+        self.overlay = {}
+        self.overlay_arrays = None
+
+    def _log_is_current(self):
+        """Check that the change log exists and belongs to the loaded base generation"""
+        try:
+            with open(self.log_path, 'rb') as f:
+                header = f.read(RELATED_HEADER.size)
+        except FileNotFoundError:
+            return False
+        if len(header) < RELATED_HEADER.size:
+            return False
+        magic, generation, _ = RELATED_HEADER.unpack(header)
+        return magic == RELATED_MAGIC and generation == self.base['generation']
+
+    def _read_log(self):
+        """Apply change log records written since the last read"""
+        try:
+            with open(self.log_path, 'rb') as f:
+                header = f.read(RELATED_HEADER.size)
+                if len(header) < RELATED_HEADER.size:
+                    return
+                magic, generation, _ = RELATED_HEADER.unpack(header)
+                # A log from another generation was already merged (or is from an interrupted merge)
+                if magic != RELATED_MAGIC or generation != self.base['generation']:
+                    return
+                f.seek(max(self.log_offset, RELATED_HEADER.size))
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        position = 0
+        while position + RELATED_RECORD.size <= len(data):
+            entry_id, stamp, count, op = RELATED_RECORD.unpack_from(data, position)
+            start = position + RELATED_RECORD.size
+            end = start + count * 8
+            if end > len(data):
+                break
+            entry_id = entry_id.rstrip(b'\0').decode()
+            if op == RELATED_UPSERT:
+                indices = np.frombuffer(data, dtype=np.int32, count=count, offset=start)
+                tf = np.frombuffer(data, dtype=np.float32, count=count, offset=start + count * 4)
+                self.overlay[entry_id] = (stamp, indices, tf)
+            else:
+                self.overlay[entry_id] = None
+            self.log_records += 1
+            position = end
+
+        if position:
+            self.log_offset = max(self.log_offset, RELATED_HEADER.size) + position
+            self.overlay_arrays = None
+
+    def _refresh(self):
+        """Pick up a new base segment or log records written by any worker"""
+        try:
+            inode = os.stat(self.base_path).st_ino
+        except FileNotFoundError:
+            self.base = None
+            return False
+        if inode != self.base_inode:
+            self._load_base()
+        self._read_log()
+        return True
+
+    def _ensure_base(self):
+        """Create an empty index if none exists (exclusive lock held)"""
+        if not self._refresh():
+            self._write_base([], 1)
+            self._reset_log(1)
+            self._refresh()
+
+    def _effective_rows(self):
+        """Yield (entry id, stamp, indices, tf) for every live entry"""
+        base = self.base
+        for row, entry_id in enumerate(base['ids']):
+            if entry_id not in self.overlay:
+                start, end = base['indptr'][row], base['indptr'][row + 1]
+                yield entry_id, base['stamps'][row], base['indices'][start:end], base['tf'][start:end]
+        for entry_id, value in self.overlay.items():
+            if value is not None:
+                yield (entry_id,) + value
+
+    def _compact(self):
+        """Merge the change log into a new base segment, recomputing IDF (exclusive lock held)"""
+        generation = self.base['generation'] + 1
+        self._write_base(list(self._effective_rows()), generation)
+        self._reset_log(generation)
+        self._refresh()
+
+    def _record(self, entry_id, entry=None):
+        """Encode an upsert (or a delete when entry is None) as a log record"""
+        if entry is None:
+            return RELATED_RECORD.pack(entry_id.encode(), 0, 0, RELATED_DELETE)
+        indices, tf = self.vectorize(entry)
+        header = RELATED_RECORD.pack(entry_id.encode(), entry_stamp(entry), len(indices), RELATED_UPSERT)
+        return header + indices.tobytes() + tf.tobytes()
+
+    def apply(self, upserts=(), deletes=()):
+        """Record new or changed entries and removed entry ids"""
+        records = [self._record(str(entry['_id']), entry) for entry in upserts]
+        records += [self._record(entry_id) for entry_id in deletes]
+        if not records:
+            return
+        with self.lock, self._file_lock(fcntl.LOCK_EX):
+            self._ensure_base()
+            # A missing or stale log (deleted, or left by a merge interrupted after
+            # the base was replaced) holds nothing the base lacks; start a fresh one
+            # so these records are not appended where no reader will look
+            if not self._log_is_current():
+                self._reset_log(self.base['generation'])
+                self.log_offset = 0
+            with open(self.log_path, 'ab') as f:
+                f.write(b''.join(records))
+            self._read_log()
+            if self.log_records >= max(RELATED_COMPACT_RECORDS, len(self.base['ids']) // 4):
+                self._compact()
+
+    def rebuild(self, entries):
+        """Replace the whole index with the given entries"""
+        rows = [(str(entry['_id']), entry_stamp(entry)) + self.vectorize(entry) for entry in entries]
+        with self.lock, self._file_lock(fcntl.LOCK_EX):
+            generation = self.base['generation'] + 1 if self._refresh() else 1
+            self._write_base(rows, generation)
+            self._reset_log(generation)
+            self._refresh()
+
+    def stamps(self):
+        """Map each indexed entry id to the stamp it was indexed at, or None if there is no index"""
+        with self.lock, self._file_lock(fcntl.LOCK_SH):
+            if not self._refresh():
+                return None
+            return {entry_id: stamp for entry_id, stamp, _, _ in self._effective_rows()}
+
+    def _overlay_arrays(self):
+        """Batch the log's live rows into CSR-style arrays weighted with the base IDF"""
+        if self.overlay_arrays is None:
+            live = [(entry_id, value) for entry_id, value in self.overlay.items() if value is not None]
+            lengths = np.array([len(value[1]) for _, value in live], dtype=np.int64)
+            row = np.repeat(np.arange(len(live), dtype=np.int32), lengths)
+            indices = np.concatenate([value[1] for _, value in live] + [np.zeros(0, dtype=np.int32)])
+            tf = np.concatenate([value[2] for _, value in live] + [np.zeros(0, dtype=np.float32)])
+            superseded = np.zeros(len(self.base['ids']), dtype=bool)
+            superseded[[self.base_rows[i] for i in self.overlay if i in self.base_rows]] = True
+            self.overlay_arrays = {
+                'ids': [entry_id for entry_id, _ in live],
+                'positions': {entry_id: position for position, (entry_id, _) in enumerate(live)},
+                'row': row,
+                'indices': indices,
+                'weights': self._normalized_weights(row, indices, tf, len(live), self.base['idf']),
+                'superseded': superseded
+            }
+        return self.overlay_arrays
+
+    def related(self, entry_id, limit):
+        """Return (entry_id, score) pairs most similar to an entry, or None if not indexed"""
+        with self.lock, self._file_lock(fcntl.LOCK_SH):
+            if not self._refresh():
+                return None
+            base = self.base
+            overlay = self._overlay_arrays()
+            value = self.overlay.get(entry_id)
+            base_count = len(base['ids'])
+            # Resolve the query row while the lock pins base and overlay together
+            if value is not None:
+                indices, tf = value[1], value[2]
+                own_position = base_count + overlay['positions'][entry_id]
+            elif entry_id in self.base_rows and entry_id not in self.overlay:
+                own_position = self.base_rows[entry_id]
+                start, end = base['indptr'][own_position], base['indptr'][own_position + 1]
+                indices, tf = base['indices'][start:end], base['tf'][start:end]
+            else:
+                return None
+
+        # Score every entry at once: one gather and one bincount per segment
+        query = np.zeros(self.features, dtype=np.float32)
+        query[indices] = tf * base['idf'][indices]
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        query /= norm
+
+        scores = np.concatenate([
+            np.bincount(base['row'], weights=base['weights'] * query[base['indices']], minlength=base_count),
+            np.bincount(overlay['row'], weights=overlay['weights'] * query[overlay['indices']], minlength=len(overlay['ids']))
+        ])
+        scores[:base_count][overlay['superseded']] = -1
+        scores[own_position] = -1
+
+        limit = min(limit, len(scores))
+        if limit <= 0:
+            return []
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (base['ids'][i] if i < base_count else overlay['ids'][i - base_count], float(scores[i]))
+            for i in top if scores[i] > 0
+        ]
+
+related_index = None
+related_index_lock = threading.Lock()
+
+def reconcile_related_index(index):
+    """Bring the related index in line with db.entries, using stamps to find stale rows"""
+    db_stamps = {
+        str(entry['_id']): entry_stamp(entry)
+        for entry in db.entries.find({}, {'updated_at': 1, 'created_at': 1})
+    }
+    indexed = index.stamps()
+    if indexed is None:
+        changed = set(db_stamps)
+    else:
+        changed = {i for i, stamp in db_stamps.items() if indexed.get(i) != stamp}
+        changed |= set(indexed) - set(db_stamps)
+    if not changed:
+        return
+
+    projection = {'content': 1, 'tags': 1, 'updated_at': 1, 'created_at': 1}
+    if indexed is None or len(changed) > max(RELATED_COMPACT_RECORDS, len(db_stamps) // 4):
+        index.rebuild(db.entries.find({}, projection))
+        return
+
+    # Re-read the changed entries so writes made since the scan above are not undone
+    upserts = list(db.entries.find({'_id': {'$in': [ObjectId(i) for i in changed]}}, projection))
+    deletes = changed - {str(entry['_id']) for entry in upserts}
+    index.apply(upserts, deletes)
+
+def get_related_index():
+    """Open the persisted related-entries index, reconciling it with the entries on first use"""
+    global related_index
+    with related_index_lock:
+        if related_index is None:
+            index = RelatedIndex(RELATED_INDEX_DIR)
+            reconcile_related_index(index)
+            related_index = index
+        return related_index
+
+def sync_related(entry_id, entry=None):
+    """Record an entry write (or deletion when entry is None) in the related index
+
+    Failures are logged rather than raised, since the entry write has already
+    been committed; the next startup reconciles any rows that were missed.
+    """
+    try:
+        index = get_related_index()
+        if entry is None:
+            index.apply(deletes=[entry_id])
+        else:
+            index.apply(upserts=[{**entry, '_id': entry_id}])
+    except Exception as e:
+        print(f"Error updating related index for entry {entry_id}: {e}")
+
 def ping_self():
     """Keep the service alive by pinging itself periodically"""
     while True:
@@ -108,6 +758,7 @@ def get_entries():
         
         for entry in entries:
             entry['id'] = str(entry.pop('_id'))
+            add_background_url(entry)
         
         return jsonify(entries)
     except Exception as e:
@@ -124,6 +775,7 @@ def get_entry(entry_id):
             return jsonify({'error': 'Entry not found'}), 404
             
         entry['id'] = str(entry.pop('_id'))
+        add_background_url(entry)
         
         # Get image information if the entry has images
         if entry.get('has_images'):
@@ -133,6 +785,7 @@ def get_entry(entry_id):
                     'id': str(img['_id']),
                     'filename': img['filename'],
                     'content_type': img['contentType'],
+                    'url': sign_file_url(img['_id']),
                     'upload_date': img['uploadDate']
                 } for img in image_files
             ]
@@ -146,6 +799,8 @@ def get_entry(entry_id):
                     'filename': voice['filename'],
                     'content_type': voice['contentType'],
                     'duration': voice.get('metadata', {}).get('duration', 0),
+                    'peaks': voice.get('metadata', {}).get('peaks', []),
+                    'url': sign_file_url(voice['_id']),
                     'upload_date': voice['uploadDate']
                 } for voice in voice_files
             ]
@@ -180,6 +835,8 @@ def add_entry():
         }
         
         result = db.entries.insert_one(entry)
+        sync_autocomplete(new_entry=entry)
+        sync_related(str(result.inserted_id), entry)
         
         return jsonify({
             'message': 'Entry added successfully',
@@ -189,6 +846,42 @@ def add_entry():
         print(f"Error adding entry: {e}")
         return jsonify({'error': 'Database error'}), 500
 
+@app.route('/entries/<entry_id>/related', methods=['GET'])
+@require_auth
+def get_related_entries(entry_id):
+    """Get the entries most similar to an entry by content and tags"""
+    try:
+        try:
+            limit = min(max(int(request.args.get('limit', 5)), 1), 50)
+        except ValueError:
+            return jsonify({'error': 'Limit must be a number'}), 400
+            
+        related = get_related_index().related(entry_id, limit)
+        if related is None:
+            return jsonify({'error': 'Entry not found'}), 404
+            
+        scores = dict(related)
+        entries = {
+            str(entry['_id']): entry for entry in db.entries.find(
+                {'_id': {'$in': [ObjectId(related_id) for related_id in scores]}},
+                {'_id': 1, 'date': 1, 'content': 1, 'mood': 1, 'tags': 1, 'location': 1, 'has_images': 1, 'has_voice': 1}
+            )
+        }
+        
+        # Keep the similarity order from the index
+        results = []
+        for related_id, score in related:
+            entry = entries.get(related_id)
+            if entry:
+                entry['id'] = str(entry.pop('_id'))
+                entry['score'] = round(score, 4)
+                results.append(entry)
+                
+        return jsonify(results)
+    except Exception as e:
+        print(f"Error fetching related entries for {entry_id}: {e}")
+        return jsonify({'error': 'Database error'}), 500
+
 @app.route('/entries/<entry_id>', methods=['PUT'])
 @require_auth
 def update_entry(entry_id):
@@ -207,13 +900,18 @@ def update_entry(entry_id):
             if field in data:
                 update_data[field] = data[field]
 
-        result = db.entries.update_one(
+        old_entry = db.entries.find_one_and_update(
             {'_id': ObjectId(entry_id)},
-            {'$set': update_data}
+            {'$set': update_data},
+            return_document=ReturnDocument.BEFORE
         )
 
-        if result.matched_count == 0:
+        if old_entry is None:
             return jsonify({'error': 'Entry not found'}), 404
+            
+        new_entry = {**old_entry, **update_data}
+        sync_autocomplete(old_entry, new_entry)
+        sync_related(entry_id, new_entry)
 
         return jsonify({'message': 'Entry updated successfully'})
     except Exception as e:
@@ -231,10 +929,13 @@ def delete_entry(entry_id):
             fs.delete(file['_id'])
         
         # Delete the entry
-        result = db.entries.delete_one({'_id': ObjectId(entry_id)})
+        deleted_entry = db.entries.find_one_and_delete({'_id': ObjectId(entry_id)})
         
-        if result.deleted_count == 0:
+        if deleted_entry is None:
             return jsonify({'error': 'Entry not found'}), 404
+            
+        sync_autocomplete(old_entry=deleted_entry)
+        sync_related(entry_id)
 
         return jsonify({'message': 'Entry deleted successfully'})
     except Exception as e:
@@ -318,8 +1019,11 @@ def upload_voice(entry_id):
         # Generate a unique filename
         filename = f"{uuid.uuid4()}-{file.filename}"
         
-        # Get duration from request if available
-        duration = request.form.get('duration', 0)
+        # Probe the real duration and waveform, falling back to the client duration
+        duration, peaks = probe_audio(file_data)
+        if duration is None:
+            duration = parse_duration(request.form.get('duration', 0))
+            peaks = []
         
         # Store the file in GridFS
         file_id = fs.put(
@@ -330,6 +1034,7 @@ def upload_voice(entry_id):
                 'entry_id': entry_id,
                 'type': 'voice',
                 'duration': duration,
+                'peaks': peaks,
                 'upload_date': datetime.datetime.now(pytz.timezone('Asia/Kolkata'))
             }
         )
@@ -343,14 +1048,37 @@ def upload_voice(entry_id):
         return jsonify({
             'message': 'Voice note uploaded successfully',
             'voice_id': str(file_id),
-            'filename': filename
+            'filename': filename,
+            'duration': duration,
+            'peaks': peaks
         })
     except Exception as e:
         print(f"Error uploading voice note: {e}")
         return jsonify({'error': 'Server error'}), 500
 
-@app.route('/files/<file_id>', methods=['GET'])
+@app.route('/entries/<entry_id>/file-urls', methods=['GET'])
 @require_auth
+def get_file_urls(entry_id):
+    """Issue signed URLs for all files attached to an entry"""
+    try:
+        entry = db.entries.find_one({'_id': ObjectId(entry_id)}, {'background': 1})
+        if not entry:
+            return jsonify({'error': 'Entry not found'}), 404
+            
+        files = db.fs.files.find({"metadata.entry_id": entry_id}, {'_id': 1})
+        urls = {str(file['_id']): sign_file_url(file['_id']) for file in files}
+        
+        background = entry.get('background')
+        if background and ObjectId.is_valid(background):
+            urls[background] = sign_file_url(background)
+            
+        return jsonify(urls)
+    except Exception as e:
+        print(f"Error signing file URLs for entry {entry_id}: {e}")
+        return jsonify({'error': 'Database error'}), 500
+
+@app.route('/files/<file_id>', methods=['GET'])
+@require_auth_or_signature
 def get_file(file_id):
     """Retrieve a file (image or voice note) from GridFS"""
     try:
@@ -358,18 +1086,33 @@ def get_file(file_id):
         if not ObjectId.is_valid(file_id):
             return jsonify({'error': 'Invalid file ID'}), 400
             
-        file = fs.get(ObjectId(file_id))
-        if not file:
+        try:
+            file = fs.get(ObjectId(file_id))
+        except gridfs.errors.NoFile:
             return jsonify({'error': 'File not found'}), 404
             
-        # Create a response with the file data
-        response = send_file(
-            io.BytesIO(file.read()),
-            mimetype=file.content_type,
-            as_attachment=True,
-            download_name=file.filename
-        )
-        
+        # Stored files never change, so the md5 (or id) is a stable ETag
+        etag = file.md5 or file_id
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            # Create a response with the file data; conditional keeps Range support for media seeking
+            response = send_file(
+                io.BytesIO(file.read()),
+                mimetype=file.content_type,
+                as_attachment=True,
+                download_name=file.filename,
+                etag=etag,
+                conditional=True
+            )
+            
+        response.set_etag(etag)
+        # Only signed URLs may be cached by shared proxies, and no longer than the signature is valid
+        if g.file_auth == 'signature':
+            max_age = max(0, min(g.file_expires - int(time.time()), SIGNED_URL_TTL))
+            response.headers['Cache-Control'] = f'public, max-age={max_age}, immutable'
+        else:
+            response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
         return response
     except Exception as e:
         print(f"Error retrieving file: {e}")
@@ -459,8 +1202,9 @@ def get_settings():
                 'font_size': 'medium'
             }
             db.user_settings.insert_one(settings)
+            settings.pop('_id', None)
         
-        return jsonify(settings)
+        return jsonify(add_settings_background_url(settings))
     except Exception as e:
         print(f"Error fetching settings: {e}")
         return jsonify({'error': 'Database error'}), 500
@@ -488,13 +1232,19 @@ def update_settings():
             if field in data:
                 update_data[field] = data[field]
                 
-        db.user_settings.update_one(
+        settings = db.user_settings.find_one_and_update(
             {},
             {'$set': update_data},
-            upsert=True
+            projection={'_id': 0, 'background_type': 1, 'background_value': 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
         )
         
-        return jsonify({'message': 'Settings updated successfully'})
+        response = {'message': 'Settings updated successfully'}
+        add_settings_background_url(settings)
+        if 'background_url' in settings:
+            response['background_url'] = settings['background_url']
+        return jsonify(response)
     except Exception as e:
         print(f"Error updating settings: {e}")
         return jsonify({'error': 'Database error'}), 500
@@ -553,7 +1303,8 @@ def upload_background():
         
         return jsonify({
             'message': 'Background uploaded successfully',
-            'background_id': str(file_id)
+            'background_id': str(file_id),
+            'background_url': sign_file_url(file_id)
         })
     except Exception as e:
         print(f"Error uploading background: {e}")
@@ -579,6 +1330,27 @@ def get_tags():
         print(f"Error fetching tags: {e}")
         return jsonify({'error': 'Database error'}), 500
 
+@app.route('/autocomplete', methods=['GET'])
+@require_auth
+def autocomplete():
+    """Suggest tags, locations or moods starting with a prefix, ranked by usage"""
+    try:
+        field = request.args.get('field', 'tags')
+        if field not in AUTOCOMPLETE_FIELDS:
+            return jsonify({'error': f"Field must be one of: {', '.join(AUTOCOMPLETE_FIELDS)}"}), 400
+            
+        prefix = request.args.get('prefix', '')
+        try:
+            limit = min(max(int(request.args.get('limit', 10)), 1), AUTOCOMPLETE_MAX_RESULTS)
+        except ValueError:
+            return jsonify({'error': 'Limit must be a number'}), 400
+            
+        suggestions = get_autocomplete_indexes()[field].complete(prefix, limit)
+        return jsonify(suggestions)
+    except Exception as e:
+        print(f"Error fetching autocomplete suggestions: {e}")
+        return jsonify({'error': 'Database error'}), 500
+
 @app.route('/entries/search', methods=['GET'])
 @require_auth
 def search_entries():
@@ -617,11 +1389,12 @@ def search_entries():
         # Execute the search
         entries = list(db.entries.find(
             search_query,
-            {'_id': 1, 'date': 1, 'content': 1, 'mood': 1, 'tags': 1, 'location': 1, 'has_images': 1, 'has_voice': 1}
+            {'_id': 1, 'date': 1, 'content': 1, 'mood': 1, 'tags': 1, 'location': 1, 'has_images': 1, 'has_voice': 1, 'background': 1}
         ).sort('created_at', -1))
         
         for entry in entries:
             entry['id'] = str(entry.pop('_id'))
+            add_background_url(entry)
             
         return jsonify(entries)
     except Exception as e:
@@ -716,6 +1489,18 @@ def not_found(e):
 def server_error(e):
     return jsonify({'error': 'Internal server error'}), 500
 
+# Warm the autocomplete and related indexes when the app is imported, including by gunicorn workers
+try:
+    reconcile_autocomplete_counts()
+    get_autocomplete_indexes()
+except Exception as e:
+    print(f"Error building autocomplete indexes: {e}")
+
+try:
+    get_related_index()
+except Exception as e:
+    print(f"Error loading related index: {e}")
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
     init_db()